@@ -5,6 +5,8 @@ import os
 import re
 import logging
 import datetime
+import signal
+import time
 
 from aiohttp import ClientConnectionError
 from aiotg import Bot, Chat, RETRY_TIMEOUT
@@ -12,12 +14,6 @@ from aiorzd import TimeRange, RzdFetcher, UpstreamError
 import asyncio
 
 logger = logging.getLogger('aiorzd_bot')
-os.environ.setdefault('BOT_CONFIG', 'config.json')
-
-with open(os.environ['BOT_CONFIG']) as cfg:
-    config = json.load(cfg)
-
-bot = Bot(config['API_TOKEN'], name=config['BOT_NAME'])
 
 shortcuts = {
     'москва': [
@@ -37,8 +33,30 @@ QUERY_REGEXP_LIST = [
     r'(?P<from>[^\s]+)\s+(?P<to>[^\s]+)(?P<when>.*)',
 ]
 
+POLL_INTERVAL = 30
+# bump on incompatible changes of the saved state format
+STATE_VERSION = 1
+
+# (regexp, handler) pairs, bot name is substituted in create_bot
+routes = []
+# autocomplete results for shortcut cities, filled on start
+stations = {}
+
 queue = asyncio.Queue()
 tasks_by_chats = collections.defaultdict(set)
+shutdown = asyncio.Event()
+# task being fetched by process_queue, it is not in the queue at the moment
+in_flight = None
+# time of the next queue poll, handed over between restarts
+next_poll = None
+
+
+def dump_time(dt):
+    return dt.isoformat() if dt else None
+
+
+def load_time(s):
+    return datetime.datetime.fromisoformat(s) if s else None
 
 
 def future_month(date, today):
@@ -56,18 +74,26 @@ def future_year(date, today):
     return date
 
 
+def route(regexp):
+    def decorator(fn):
+        routes.append((regexp, fn))
+        return fn
+    return decorator
+
+
 def multibot(command, default=False):
     def decorator(fn):
         for r in QUERY_REGEXP_LIST:
-            fn = bot.command(r'/%s@%s\s+%s' % (command, bot.name, r))(fn)
-            fn = bot.command(r'/%s\s+%s' % (command, r))(fn)
+            fn = route(r'/%s@{bot_name}\s+%s' % (command, r))(fn)
+            fn = route(r'/%s\s+%s' % (command, r))(fn)
             if default:
-                fn = bot.command(r'@%s\s+%s' % (bot.name, r))(fn)
+                fn = route(r'@{bot_name}\s+%s' % r)(fn)
 
         return fn
     return decorator
 
 
+
 class TooLongPeriod(Exception):
     pass
 
@@ -83,7 +109,9 @@ class NotifyExceptions:
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         if exc_val:
             if issubclass(exc_type, asyncio.CancelledError):
-                await self.chat.send_text("Фоновая задача была отменена")
+                # task is handed over to the next process on shutdown
+                if not shutdown.is_set():
+                    await self.chat.send_text("Фоновая задача была отменена")
             else:
                 self.exception = exc_val
                 await self.chat.send_text("Ошибка: %s" % str(exc_val))
@@ -122,6 +150,9 @@ class SeatFilter:
             'В одном купе' if self.same_coupe else '',
         )))
 
+    def to_dict(self):
+        return dict(vars(self))
+
 
 class QueryString:
     def __init__(self, match):
@@ -186,6 +217,33 @@ class QueryString:
             str(self.seats_filter) if self.seats_filter else '',
         )
 
+    def to_dict(self):
+        return {
+            'city_from': self.city_from,
+            'city_to': self.city_to,
+            'start': dump_time(self.time_range.start),
+            'end': dump_time(self.time_range.end),
+            'max_price': self.max_price,
+            'min_tickets': self.min_tickets,
+            'types_filter': self.types_filter,
+            'seats_filter': self.seats_filter.to_dict()
+            if self.seats_filter else None,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        query = cls.__new__(cls)
+        query.city_from = d['city_from']
+        query.city_to = d['city_to']
+        query.time_range = TimeRange(load_time(d['start']),
+                                     load_time(d['end']))
+        query.max_price = d['max_price']
+        query.min_tickets = d['min_tickets']
+        query.types_filter = d['types_filter']
+        query.seats_filter = SeatFilter(**d['seats_filter']) \
+            if d['seats_filter'] else None
+        return query
+
     @staticmethod
     def parse_max_price(max_price):
         if '#' in max_price:
@@ -331,6 +389,59 @@ class QueueItem:
             if self.query.min_tickets else '',
         )
 
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'chat_id': self.chat.id,
+            'chat_type': self.chat.type,
+            'query': self.query.to_dict(),
+            'start_time': dump_time(self.start_time),
+            'deadline': dump_time(self.deadline),
+            'last_call': dump_time(self.last_call),
+            'last_notify': dump_time(self.last_notify),
+            'city_from': self.city_from,
+            'city_to': self.city_to,
+        }
+
+    @classmethod
+    def from_dict(cls, d, bot: Bot):
+        task = cls(
+            Chat(bot, d['chat_id'], d['chat_type']),
+            QueryString.from_dict(d['query']),
+            start_time=load_time(d['start_time']),
+            deadline=load_time(d['deadline']),
+            city_from=d['city_from'],
+            city_to=d['city_to'],
+        )
+        task.last_call = load_time(d['last_call'])
+        task.last_notify = load_time(d['last_notify'])
+        # keep ids stable for /stopN commands sent before restart
+        task.id = int(d['id'])
+        cls.counter = max(cls.counter, task.id + 1)
+        return task
+
+
+async def get_station(fetcher: RzdFetcher, city):
+    if city in stations:
+        return stations[city]
+    station = await fetcher.get_city_autocomplete(city)
+    # do not keep arbitrary user input, only well-known cities
+    if city in shortcuts:
+        stations[city] = station
+    return station
+
+
+async def warm_stations():
+    async with RzdFetcher() as fetcher:
+        # wait for all lookups before the fetcher is closed
+        results = await asyncio.gather(
+            *(get_station(fetcher, c) for c in shortcuts),
+            return_exceptions=True,
+        )
+    for city, result in zip(shortcuts, results):
+        if isinstance(result, Exception):
+            logger.warning('Cannot resolve %s: %s', city, repr(result))
+
 
 async def get_trains(fetcher: RzdFetcher, query: QueryString):
     trains = await with_retry(
@@ -409,77 +520,105 @@ async def get_trains(fetcher: RzdFetcher, query: QueryString):
     return list(filtered_trains), trains
 
 
+async def next_task():
+    while True:
+        task: QueueItem = await queue.get()
+        # queue is not filtered, check for presence in dict instead
+        if task in tasks_by_chats[task.chat.id]:
+            return task
+
+
+async def sleep_or_shutdown(delay):
+    """Sleep for delay seconds, return True if shutdown is requested"""
+    try:
+        await asyncio.wait_for(shutdown.wait(), delay)
+    except asyncio.TimeoutError:
+        pass
+    return shutdown.is_set()
+
+
 async def process_queue():
+    global in_flight, next_poll
+
     async with RzdFetcher() as fetcher:
-        while True:
-            try:
-                now = datetime.datetime.now()
-                while True:
-                    task: QueueItem = await queue.get()
-                    if task in tasks_by_chats[task.chat.id]:
-                        break
-
-                task.last_call = now
-                async with NotifyExceptions(task.chat):
-                    logger.debug(f'Fetch data for {task.query}')
-                    filtered_trains, all_trains = await get_trains(fetcher,
-                                                                   task.query)
-                    if filtered_trains:
-                        answer = 'Найдено: \n'
-                        for train in filtered_trains[0:30]:
-                            answer += \
-                                '<b>{date}</b>\n' \
-                                '<i>{num} {title}</i>\n' \
-                                '{seats}\n\n'.format(
-                                    date=train.departure_time,
-                                    num=train.number,
-                                    title=train.title,
-                                    seats="\n".join(
-                                        " - %s" % s
-                                        for s in train.seats.values()
-                                    ),
-                                )
-                        if len(filtered_trains) > 30:
-                            answer += \
-                                'Есть ещё поезда, сократите диапазон дат... '
-                        tasks_by_chats[task.chat.id].remove(task)
-                        await task.chat.send_text(answer, parse_mode='HTML')
+        if next_poll:
+            # resume the schedule of the previous process
+            delay = (next_poll - datetime.datetime.now()).total_seconds()
+            if delay > 0 and await sleep_or_shutdown(delay):
+                return
+
+        while not shutdown.is_set():
+            getter = asyncio.ensure_future(next_task())
+            stopper = asyncio.ensure_future(shutdown.wait())
+            await asyncio.wait({getter, stopper},
+                               return_when=asyncio.FIRST_COMPLETED)
+            stopper.cancel()
+            if not getter.done():
+                getter.cancel()
+                return
+
+            task = in_flight = getter.result()
+            now = datetime.datetime.now()
+            task.last_call = now
+            async with NotifyExceptions(task.chat):
+                logger.debug(f'Fetch data for {task.query}')
+                filtered_trains, all_trains = await get_trains(fetcher,
+                                                               task.query)
+                if filtered_trains:
+                    answer = 'Найдено: \n'
+                    for train in filtered_trains[0:30]:
+                        answer += \
+                            '<b>{date}</b>\n' \
+                            '<i>{num} {title}</i>\n' \
+                            '{seats}\n\n'.format(
+                                date=train.departure_time,
+                                num=train.number,
+                                title=train.title,
+                                seats="\n".join(
+                                    " - %s" % s
+                                    for s in train.seats.values()
+                                ),
+                            )
+                    if len(filtered_trains) > 30:
+                        answer += \
+                            'Есть ещё поезда, сократите диапазон дат... '
+                    tasks_by_chats[task.chat.id].remove(task)
+                    await task.chat.send_text(answer, parse_mode='HTML')
+                else:
+                    now = datetime.datetime.now()
+                    if task.deadline and now > task.deadline:
+                        await task.chat.send_text(
+                            'Ничего не нашёл. Прекращаю работу.')
                     else:
-                        now = datetime.datetime.now()
-                        if task.deadline and now > task.deadline:
+                        await queue.put(task)
+                        if (now - task.last_notify).seconds > 3600:
+                            task.last_notify = now
+                            time_start = task.query.time_range.start.\
+                                strftime("%Y-%m-%d %H:%M")
+                            time_end = task.query.time_range.end.\
+                                strftime("%Y-%m-%d %H:%M")
                             await task.chat.send_text(
-                                'Ничего не нашёл. Прекращаю работу.')
-                        else:
-                            await queue.put(task)
-                            if (now - task.last_notify).seconds > 3600:
-                                task.last_notify = now
-                                time_start = task.query.time_range.start.\
-                                    strftime("%Y-%m-%d %H:%M")
-                                time_end = task.query.time_range.end.\
-                                    strftime("%Y-%m-%d %H:%M")
-                                await task.chat.send_text(
-                                    'Всё ещё нет билетов '
-                                    '{city_from} – {city_to} '
-                                    '{time_start} - {time_end}. '
-                                    'Ищу уже {working} секунд.\n'
-                                    'Продолжаю поиск...'.format(
-                                        city_from=task.city_from,
-                                        city_to=task.city_to,
-                                        time_start=time_start,
-                                        time_end=time_end,
-                                        working=(
-                                            now - task.start_time
-                                        ).seconds,
-                                    ),
-                                )
-            except asyncio.CancelledError:
-                raise
-            # except:  # noqa
-            #     pass
-            try:
-                logger.debug('Sleep for 30 seconds')
-                await asyncio.sleep(30)
-            except asyncio.CancelledError:
+                                'Всё ещё нет билетов '
+                                '{city_from} – {city_to} '
+                                '{time_start} - {time_end}. '
+                                'Ищу уже {working} секунд.\n'
+                                'Продолжаю поиск...'.format(
+                                    city_from=task.city_from,
+                                    city_to=task.city_to,
+                                    time_start=time_start,
+                                    time_end=time_end,
+                                    working=(
+                                        now - task.start_time
+                                    ).seconds,
+                                ),
+                            )
+            in_flight = None
+
+            next_poll = datetime.datetime.now() + datetime.timedelta(
+                seconds=POLL_INTERVAL,
+            )
+            logger.debug('Sleep for %s seconds', POLL_INTERVAL)
+            if await sleep_or_shutdown(POLL_INTERVAL):
                 return
 
 
@@ -495,38 +634,36 @@ async def notify(chat: Chat, match):
 
     async with RzdFetcher() as fetcher:
         async with NotifyExceptions(chat) as notifier:
-            city_from = (
-                await fetcher.get_city_autocomplete(query.city_from)
-            )['n']
-            city_to = (await fetcher.get_city_autocomplete(query.city_to))['n']
-        if notifier.exception:
-            return
+            city_from = (await get_station(fetcher, query.city_from))['n']
+            city_to = (await get_station(fetcher, query.city_to))['n']
+    if notifier.exception:
+        return
 
-        msg = """Буду искать по запросу {} -> {}, с {} по {}{}{}{}{}""".format(
-            city_from,
-            city_to,
-            query.time_range.start,
-            query.time_range.end,
-            ' не дороже {} рублей'.format(query.max_price)
-            if query.max_price else '',
-            ' только {}'.format(",".join(query.types_filter))
-            if query.types_filter else '',
-            ' не меньше {} мест в одном поезде'.format(query.min_tickets)
-            if query.min_tickets else '',
-            query.seats_filter or '',
-        )
-        await chat.send_text(msg)
-        start_time = datetime.datetime.now()
-        task = QueueItem(
-            chat,
-            query,
-            start_time=start_time,
-            deadline=start_time + datetime.timedelta(days=1),
-            city_from=city_from,
-            city_to=city_to,
-        )
-        tasks_by_chats[chat.id].add(task)
-        await queue.put(task)
+    msg = """Буду искать по запросу {} -> {}, с {} по {}{}{}{}{}""".format(
+        city_from,
+        city_to,
+        query.time_range.start,
+        query.time_range.end,
+        ' не дороже {} рублей'.format(query.max_price)
+        if query.max_price else '',
+        ' только {}'.format(",".join(query.types_filter))
+        if query.types_filter else '',
+        ' не меньше {} мест в одном поезде'.format(query.min_tickets)
+        if query.min_tickets else '',
+        query.seats_filter or '',
+    )
+    await chat.send_text(msg)
+    start_time = datetime.datetime.now()
+    task = QueueItem(
+        chat,
+        query,
+        start_time=start_time,
+        deadline=start_time + datetime.timedelta(days=1),
+        city_from=city_from,
+        city_to=city_to,
+    )
+    tasks_by_chats[chat.id].add(task)
+    await queue.put(task)
 
 
 @multibot('search', default=True)
@@ -571,7 +708,7 @@ async def search(chat: Chat, match):
     await chat.send_text(answer, parse_mode='HTML')
 
 
-@bot.command('/status')
+@route('/status')
 async def status(chat: Chat, match):
     tasks = tasks_by_chats[chat.id]
     if tasks:
@@ -583,7 +720,7 @@ async def status(chat: Chat, match):
     await chat.send_text(answer, parse_mode='HTML')
 
 
-@bot.command(r'/stop(\d+)')
+@route(r'/stop(\d+)')
 async def stop(chat: Chat, match):
     async with NotifyExceptions(chat) as notifier:
         tasks = list(filter(
@@ -605,13 +742,12 @@ async def stop(chat: Chat, match):
     await chat.send_text(answer, parse_mode='HTML')
 
 
-@bot.default
 def default(chat: Chat, match):
     logger.warning('Not matched request: {}'.format(match))
     return chat.send_text('Не понял...')
 
 
-@bot.command("(/start|/?help)")
+@route("(/start|/?help)")
 def usage(chat: Chat, match):
     demo_date = datetime.date.today() + datetime.timedelta(days=30)
     logger.info('Start request: {}'.format(match))
@@ -623,10 +759,84 @@ def usage(chat: Chat, match):
     return chat.send_text(text)
 
 
-async def stop_bot():
+def save_state(path):
+    """Dump scheduled tasks for the next process instead of dropping them"""
+    tasks = []
+    if in_flight and in_flight in tasks_by_chats[in_flight.chat.id]:
+        tasks.append(in_flight)
     while not queue.empty():
-        task = await queue.get()
-        task.chat.send_text('Bot is quitting. Bye!')
+        task = queue.get_nowait()
+        if task not in tasks and task in tasks_by_chats[task.chat.id]:
+            tasks.append(task)
+
+    state = {
+        'version': STATE_VERSION,
+        'next_poll': dump_time(next_poll),
+        'tasks': [t.to_dict() for t in tasks],
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    logger.warning('Saved %d tasks to %s', len(tasks), path)
+
+
+def discard_state(path, reason):
+    # keep the file for investigation, but do not fail on it on every start
+    os.replace(path, path + '.bad')
+    logger.error('Cannot load %s: %s, moved to %s.bad', path, reason, path)
+
+
+def read_state(path):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        discard_state(path, repr(e))
+        return None
+
+    if not isinstance(state, dict) or \
+            state.get('version') != STATE_VERSION or \
+            not isinstance(state.get('tasks'), list):
+        discard_state(path, 'unsupported format')
+        return None
+    return state
+
+
+def restore_state(state, bot: Bot):
+    global next_poll
+
+    try:
+        next_poll = load_time(state.get('next_poll'))
+    except (TypeError, ValueError) as e:
+        logger.warning('Ignore saved next poll time: %s', repr(e))
+
+    restored = 0
+    for d in state['tasks']:
+        try:
+            task = QueueItem.from_dict(d, bot)
+        except Exception as e:
+            logger.warning('Skip saved task %s: %s', d, repr(e))
+            continue
+        tasks_by_chats[task.chat.id].add(task)
+        queue.put_nowait(task)
+        restored += 1
+    logger.warning('Restored %d of %d tasks', restored, len(state['tasks']))
+
+
+async def drain(timeout):
+    """Let running handlers and polls finish, cancel them after timeout"""
+    current = asyncio.current_task()
+    pending = {t for t in asyncio.all_tasks() if t is not current}
+    if pending:
+        _, pending = await asyncio.wait(pending, timeout=timeout)
+    for t in pending:
+        logger.warning('Cancel unfinished task %s', t)
+        t.cancel()
+    others = [t for t in asyncio.all_tasks() if t is not current]
+    await asyncio.gather(*others, return_exceptions=True)
 
 
 def patch_bot_api_call(bot: Bot):
@@ -647,31 +857,105 @@ def patch_bot_api_call(bot: Bot):
     bot.api_call = api_call_with_handle_exceptions
 
 
+def load_config(path=None):
+    path = path or os.environ.get('BOT_CONFIG', 'config.json')
+    with open(path) as cfg:
+        return json.load(cfg)
+
+
+def create_bot(config):
+    bot = Bot(config['API_TOKEN'], name=config['BOT_NAME'])
+    for regexp, fn in routes:
+        bot.add_command(regexp.replace('{bot_name}', bot.name), fn)
+    bot.default(default)
+    return bot
+
+
+async def timed(timings, name, coro):
+    start = time.monotonic()
+    try:
+        return await coro
+    except asyncio.CancelledError:
+        logger.warning('Warm up of %s is cancelled', name)
+        raise
+    except Exception as e:
+        # cold start is slower but still works
+        logger.warning('Warm up of %s failed: %s', name, repr(e))
+    finally:
+        timings[name] = time.monotonic() - start
+
+
+async def warm_up(bot: Bot, state_file, timeout, timings):
+    start = time.monotonic()
+    state = read_state(state_file)
+    if state:
+        restore_state(state, bot)
+        # the snapshot is consumed once, do not resurrect tasks on next restart
+        os.remove(state_file)
+    timings['state'] = time.monotonic() - start
+
+    # slow upstream must not delay serving updates or block shutdown
+    warm_future = asyncio.ensure_future(asyncio.gather(
+        timed(timings, 'telegram', bot.api_call('getMe')),
+        timed(timings, 'stations', warm_stations()),
+    ))
+    stop_future = asyncio.ensure_future(shutdown.wait())
+    await asyncio.wait([warm_future, stop_future], timeout=timeout,
+                       return_when=asyncio.FIRST_COMPLETED)
+    stop_future.cancel()
+    if not warm_future.done():
+        warm_future.cancel()
+        await asyncio.gather(warm_future, return_exceptions=True)
+
+
 async def main():
+    timings = {}
+    start = time.monotonic()
+    config = load_config()
+    state_file = config.get('STATE_FILE', 'rzdbot_state.json')
+    shutdown_timeout = config.get('SHUTDOWN_TIMEOUT', 60)
+    warm_up_timeout = config.get('WARM_UP_TIMEOUT', 10)
+    bot = create_bot(config)
+    # do not get down on aiohttp exceptions
+    patch_bot_api_call(bot)
+    timings['bot'] = time.monotonic() - start
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, shutdown.set)
+
+    await warm_up(bot, state_file, warm_up_timeout, timings)
+    logger.warning(
+        'Started in %.3fs: %s',
+        time.monotonic() - start,
+        ', '.join('%s %.3fs' % (name, t) for name, t in timings.items()),
+    )
+
     bot_future = asyncio.ensure_future(bot.loop())
     task_future = asyncio.ensure_future(process_queue())
+    stop_future = asyncio.ensure_future(shutdown.wait())
     try:
-        await asyncio.gather(bot_future, task_future)
-    except (Exception, asyncio.CancelledError):
-        try:
-            await stop_bot()
-        except (Exception, asyncio.CancelledError):
-            pass
+        done, _ = await asyncio.wait(
+            [bot_future, task_future, stop_future],
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        for t in done:
+            if t is not stop_future and t.exception():
+                logger.error('Unexpected exit: %s', repr(t.exception()))
+    finally:
+        logger.warning('Shutting down...')
+        shutdown.set()
+        # stop accepting updates, unconfirmed ones go to the next process
         bot.stop()
-
-        for t in [bot_future, task_future]:
-            try:
-                t.cancel()
-                await t
-            except asyncio.CancelledError:
-                pass
+        bot_future.cancel()
+        try:
+            await drain(shutdown_timeout)
+        finally:
+            save_state(state_file)
 
 
 if __name__ == '__main__':
     logger.setLevel(logging.DEBUG)
     logger.warning('Start RZD telegram bot...')
 
-    # do not get down on aiohttp exceptions
-    patch_bot_api_call(bot)
-
     asyncio.run(main())